@@ -3,10 +3,12 @@ import re
 import json
 import time
 import smtplib
+import ssl
 import requests
-from dataclasses import dataclass, asdict
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from typing import List, Dict, Tuple
-from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from urllib.parse import urlencode, urljoin
 
@@ -35,10 +37,14 @@ COMUNE_ALIASES = {
     "GRASSOBBIO": "Grassobbio",
 }
 
+CONNECT_TIMEOUT = 10
 REQUEST_TIMEOUT = 25
 MAX_RETRIES = 3
 SLEEP_BETWEEN_RETRIES = 2
 
+# scrape concorrenti massimi (non martelliamo il sito del tribunale)
+SCRAPE_WORKERS = int(os.environ.get("SCRAPE_WORKERS", "4").strip() or "4")
+
 # EMAIL (Gmail App Password)
 EMAIL_USER = os.environ.get("EMAIL_USER", "").strip()
 EMAIL_PASS = os.environ.get("EMAIL_PASS", "").strip()
@@ -51,7 +57,25 @@ STATE_PATH = os.environ.get("STATE_PATH", ".state/state.json").strip()
 FORCE_EMAIL = os.environ.get("FORCE_EMAIL", "0").strip() == "1"
 
 
-@dataclass
+# =========================
+# REGEX (compilate una volta a livello modulo)
+# =========================
+SCHEDA_RE = re.compile(r"scheda\s+dettagliata", re.I)
+DATA_RE = re.compile(r"Data\s+(\d{2}/\d{2}/(?:19|20)\d{2}\s*-\s*\d{2}:\d{2})", re.I)
+PREZZO_RE = re.compile(r"Prezzo\s+base\s+€\s*([0-9\.\,]+)", re.I)
+PROC_RE = re.compile(r"Procedura\s+([0-9]{1,6}/[0-9]{4})", re.I)
+LOTTO_RE = re.compile(r"\bLotto\s+([0-9]+)\b", re.I)
+TIPOLOGIA_RE = re.compile(r"Tipologia\s+(.+?)\s+Quota", re.I)
+
+
+def norm_text(s: str) -> str:
+    """
+    Normalizza spazi/nbsp (split/join in C: più veloce del motore regex).
+    """
+    return " ".join((s or "").split())
+
+
+@dataclass(slots=True)
 class Notice:
     comune: str
     titolo: str
@@ -76,33 +100,61 @@ def norm_comune(c: str) -> str:
     return COMUNE_ALIASES.get(up, (c or "").strip())
 
 
+# comuni già normalizzati una volta per tutte
+COMUNI_NORM = [norm_comune(c) for c in COMUNI]
+
+
+# parametri di ricerca fissi: cambia solo il comune
+SEARCH_PARAMS_BASE = {
+    "regione": REGIONE,
+    "provincia": PROVINCIA,
+    "limit": "50",
+    "tipologia": "",
+    "tipo_procedura": "",
+    "rge": "",
+    "rge_anno": "",
+    "prezzo_da": "",
+    "prezzo_a": "",
+    "orderby": "",
+    "tipologia_lotto": "1",  # Beni Immobili
+}
+
+
 def build_search_url(comune: str) -> str:
-    params = {
-        "regione": REGIONE,
-        "provincia": PROVINCIA,
-        "comune": comune,
-        "limit": "50",
-        "tipologia": "",
-        "tipo_procedura": "",
-        "rge": "",
-        "rge_anno": "",
-        "prezzo_da": "",
-        "prezzo_a": "",
-        "orderby": "",
-        "tipologia_lotto": "1",  # Beni Immobili
-    }
+    params = dict(SEARCH_PARAMS_BASE, comune=comune)
     return f"{BASE_TRIB_SEARCH_URL}?{urlencode(params)}"
 
 
+# sessione condivisa: keep-alive invece di un handshake TCP/TLS per richiesta
+SESSION = requests.Session()
+# pool dimensionato sugli scrape concorrenti (un thread per comune)
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10))
+SESSION.headers.update({
+    "User-Agent": "Mozilla/5.0 (AsteBergamoBot/UPDATES)",
+    "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.1",
+    "Accept-Language": "it-IT,it;q=0.9,en;q=0.7",
+})
+
+
+def normalize_href(href: str, base: str) -> str:
+    """
+    Rende assoluto l'href di una scheda (protocol-relative, root-relative
+    o relativo alla pagina di ricerca).
+    """
+    if href.startswith("//"):
+        return "https:" + href
+    if href.startswith("/"):
+        return urljoin(TRIB_DOMAIN, href)
+    if href[:4].lower() != "http":
+        return urljoin(base, href)
+    return href
+
+
 def http_get(url: str) -> str:
-    headers = {
-        "User-Agent": "Mozilla/5.0 (AsteBergamoBot/UPDATES)",
-        "Accept-Language": "it-IT,it;q=0.9,en;q=0.7",
-    }
     last_err = None
     for attempt in range(1, MAX_RETRIES + 1):
         try:
-            r = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+            r = SESSION.get(url, timeout=(CONNECT_TIMEOUT, REQUEST_TIMEOUT))
             r.raise_for_status()
             return r.text
         except Exception as e:
@@ -112,8 +164,8 @@ def http_get(url: str) -> str:
     raise RuntimeError(f"HTTP GET fallito: {url} -> {last_err}")
 
 
-def extract_first(text: str, pattern: str, default: str = "n/d", flags=0) -> str:
-    m = re.search(pattern, text or "", flags)
+def extract_first(text: str, pattern: re.Pattern, default: str = "n/d") -> str:
+    m = pattern.search(text or "")
     if not m:
         return default
     if m.groups():
@@ -126,7 +178,7 @@ def climb_block(a_tag) -> str:
     Prende solo il blocco dell'annuncio (non tutta la pagina).
     """
     current = a_tag
-    best = a_tag
+    best_txt = norm_text(a_tag.get_text(" ", strip=True))
 
     while True:
         parent = getattr(current, "parent", None)
@@ -135,18 +187,17 @@ def climb_block(a_tag) -> str:
         if getattr(parent, "name", "") in ("body", "html"):
             break
 
-        schede = parent.find_all("a", string=re.compile(r"scheda\s+dettagliata", re.I))
-        if len(schede) > 1:
+        txt = norm_text(parent.get_text(" ", strip=True))
+        # più di una scheda nel blocco => siamo saliti troppo
+        if txt.lower().count("scheda dettagliata") > 1:
             break
-
-        txt = parent.get_text(" ", strip=True)
         if len(txt) > 1500:
             break
 
-        best = parent
         current = parent
+        best_txt = txt
 
-    return best.get_text(" ", strip=True)
+    return best_txt
 
 
 def scrape_comune(comune_raw: str) -> List[Notice]:
@@ -154,39 +205,36 @@ def scrape_comune(comune_raw: str) -> List[Notice]:
     url = build_search_url(comune)
 
     html = http_get(url)
-    soup = BeautifulSoup(html, "lxml")
 
-    schede = soup.find_all("a", string=re.compile(r"scheda\s+dettagliata", re.I))
+    # nessuna scheda nella pagina => inutile costruire l'albero BS4
+    if "scheda" not in html.lower():
+        return []
 
-    notices: List[Notice] = []
-    seen = set()
+    soup = BeautifulSoup(html, "lxml")
+
+    schede = soup.find_all("a", href=True, string=SCHEDA_RE)
 
+    # dedup mantenendo l'ordine: primo anchor vincente per ogni href
+    by_href = {}
     for a in schede:
-        href = (a.get("href") or "").strip()
+        href = a["href"].strip()
         if not href:
             continue
 
-        if href.startswith("//"):
-            href = "https:" + href
-        elif href.startswith("/"):
-            href = urljoin(TRIB_DOMAIN, href)
-        elif not href.lower().startswith("http"):
-            href = urljoin(url, href)
-
-        if href in seen:
-            continue
-        seen.add(href)
+        by_href.setdefault(normalize_href(href, url), a)
 
+    notices: List[Notice] = []
+    for href, a in by_href.items():
         block_text = climb_block(a)
 
-        data_v = extract_first(block_text, r"Data\s+(\d{2}/\d{2}/\d{4}\s*-\s*\d{2}:\d{2})", "n/d", re.I)
-        prezzo = extract_first(block_text, r"Prezzo\s+base\s+€\s*([0-9\.\,]+)", "n/d", re.I)
+        data_v = extract_first(block_text, DATA_RE, "n/d")
+        prezzo = extract_first(block_text, PREZZO_RE, "n/d")
         if prezzo != "n/d":
             prezzo = f"€ {prezzo}"
 
-        proc = extract_first(block_text, r"Procedura\s+([0-9]{1,6}/[0-9]{4})", "", re.I)
-        lotto = extract_first(block_text, r"\bLotto\s+([0-9]+)\b", "", re.I)
-        tipologia = extract_first(block_text, r"Tipologia\s+(.+?)\s+Quota", "", re.I)
+        proc = extract_first(block_text, PROC_RE, "")
+        lotto = extract_first(block_text, LOTTO_RE, "")
+        tipologia = extract_first(block_text, TIPOLOGIA_RE, "")
 
         titolo_parts = []
         if proc:
@@ -261,7 +309,7 @@ def format_email_only_updates(new_items: Dict[str, List[Notice]]) -> str:
     out.append("")
 
     total = 0
-    for comune in [norm_comune(c) for c in COMUNI]:
+    for comune in COMUNI_NORM:
         lst = new_items.get(comune, [])
         if not lst:
             continue
@@ -269,18 +317,23 @@ def format_email_only_updates(new_items: Dict[str, List[Notice]]) -> str:
         out.append(f"{comune} ({len(lst)})")
         for i, n in enumerate(lst, 1):
             total += 1
-            out.append(f"{i}. {n.titolo}")
-            out.append(f"   Data vendita: {n.data_vendita}")
-            out.append(f"   Prezzo base: {n.prezzo_base}")
-            out.append(f"   LINK DIRETTO: {n.link_diretto}")
-            out.append(f"   LINK RICERCA: {n.link_ricerca}")
-            out.append("")
+            out.append(
+                f"{i}. {n.titolo}\n"
+                f"   Data vendita: {n.data_vendita}\n"
+                f"   Prezzo base: {n.prezzo_base}\n"
+                f"   LINK DIRETTO: {n.link_diretto}\n"
+                f"   LINK RICERCA: {n.link_ricerca}\n"
+            )
         out.append("")
 
     out.append(f"Totale nuovi annunci: {total}")
     return "\n".join(out).strip()
 
 
+# contesto SSL creato una volta (carica il CA bundle dal disco)
+SSL_CTX = ssl.create_default_context()
+
+
 def send_email(subject: str, body: str) -> None:
     """
     Se SMTP fallisce, NON deve far fallire il job.
@@ -289,14 +342,14 @@ def send_email(subject: str, body: str) -> None:
         print("EMAIL NON INVIATA: manca EMAIL_USER o EMAIL_PASS nei secrets.")
         return
 
-    msg = MIMEMultipart()
+    # corpo unico in testo semplice: niente involucro multipart
+    msg = MIMEText(body, "plain", "utf-8")
     msg["From"] = EMAIL_USER
     msg["To"] = EMAIL_TO
     msg["Subject"] = subject
-    msg.attach(MIMEText(body, "plain", "utf-8"))
 
     try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
+        with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=SSL_CTX) as server:
             server.login(EMAIL_USER, EMAIL_PASS)
             server.send_message(msg)
         print("Email inviata OK.")
@@ -305,16 +358,20 @@ def send_email(subject: str, body: str) -> None:
 
 
 def main() -> int:
-    # 1) scrape
-    results: Dict[str, List[Notice]] = {norm_comune(c): [] for c in COMUNI}
-    for comune in COMUNI:
-        c = norm_comune(comune)
+    # 1) scrape (in parallelo: il tempo è quasi tutto attesa HTTP)
+    results: Dict[str, List[Notice]] = {c: [] for c in COMUNI_NORM}
+
+    def scrape_safe(comune: str) -> Tuple[str, List[Notice]]:
         try:
-            results[c] = scrape_comune(c)
+            return comune, scrape_comune(comune)
         except Exception as e:
             # se un comune fallisce, non blocchiamo
-            print(f"[ERRORE] {c}: {e}")
-            results[c] = []
+            print(f"[ERRORE] {comune}: {e}")
+            return comune, []
+
+    with ThreadPoolExecutor(max_workers=min(SCRAPE_WORKERS, len(COMUNI_NORM))) as pool:
+        for c, notices in pool.map(scrape_safe, COMUNI_NORM):
+            results[c] = notices
 
     # 2) carica stato precedente
     prev = load_state(STATE_PATH)